@@ -176,21 +176,23 @@ class Transformer(AdaptContext):
         # If we have dumpers, it means set_dumper_types had been called, in
         # which case self.types and self.formats are set to sequences of the
         # right size.
-        if self._row_dumpers:
+        dumpers = self._row_dumpers
+        if dumpers:
             for i in range(nparams):
                 param = params[i]
                 if param is not None:
-                    out[i] = self._row_dumpers[i].dump(param)
+                    out[i] = dumpers[i].dump(param)
             return out
 
         types = [self._get_none_oid()] * nparams
         pqformats = [TEXT] * nparams
+        get_dumper = self.get_dumper
 
         for i in range(nparams):
             param = params[i]
             if param is None:
                 continue
-            dumper = self.get_dumper(param, formats[i])
+            dumper = get_dumper(param, formats[i])
             out[i] = dumper.dump(param)
             types[i] = dumper.oid
             pqformats[i] = dumper.format
@@ -4,26 +4,34 @@ Utility module to manipulate queries
 
 # Copyright (C) 2020 The Psycopg Team
 
-import re
-from typing import Any, Dict, List, Mapping, Match, NamedTuple, Optional
-from typing import Sequence, Tuple, Union, TYPE_CHECKING
+from typing import Any, Dict, List, Mapping, Optional
+from typing import Sequence, Tuple, Union, cast, TYPE_CHECKING
 from functools import lru_cache
+from typing_extensions import TypeAlias
 
 from . import pq
 from . import errors as e
 from .sql import Composable
 from .abc import Buffer, Query, Params
 from ._enums import PyFormat
+from ._cmodule import _psycopg
 from ._encodings import conn_encoding
 
 if TYPE_CHECKING:
     from .abc import Transformer
 
+# Maximum number of distinct queries whose conversion is cached.
+_QUERY_CACHE_SIZE = 1024
 
-class QueryPart(NamedTuple):
-    pre: bytes
-    item: Union[int, str]
-    format: PyFormat
+# Maximum length of a str query whose encoding is cached. Queries without
+# parameters are never cached: they are often one-off with inlined literals.
+_MAX_CACHED_QUERY_LEN = 8192
+
+# The placeholders of a query: either all indexes or all names
+QueryItems: TypeAlias = Union[List[int], List[str]]
+
+# The items of a query without placeholders (never modified)
+_NO_ITEMS: List[int] = []
 
 
 class PostgresQuery:
@@ -33,7 +41,7 @@ class PostgresQuery:
 
     __slots__ = """
         query params types formats
-        _tx _want_formats _parts _encoding _order
+        _tx _want_formats _items _encoding _order
         """.split()
 
     def __init__(self, transformer: "Transformer"):
@@ -48,7 +56,7 @@ class PostgresQuery:
         self.formats: Optional[Sequence[pq.Format]] = None
 
         self._encoding = conn_encoding(transformer.connection)
-        self._parts: List[QueryPart]
+        self._items: QueryItems
         self.query = b""
         self._order: Optional[List[str]] = None
 
@@ -59,20 +67,39 @@ class PostgresQuery:
         The results of this function can be obtained accessing the object
         attributes (`query`, `params`, `types`, `formats`).
         """
+        if vars is None and type(query) is bytes:
+            # Fast path for a query with no parameters: nothing to convert
+            self.query = query
+            self._want_formats = self._order = None
+            self.params = None
+            self.types = ()
+            self.formats = None
+            return
+
         if isinstance(query, str):
-            bquery = query.encode(self._encoding)
+            if vars is not None and len(query) <= _MAX_CACHED_QUERY_LEN:
+                bquery = _encode_query(query, self._encoding)
+            else:
+                bquery = query.encode(self._encoding)
         elif isinstance(query, Composable):
             bquery = query.as_bytes(self._tx)
         else:
             bquery = query
 
-        if vars is not None:
+        # Note: an int needle is a plain memchr(), much faster than b"%"
+        if vars is not None and 0x25 in bquery:
             (
                 self.query,
                 self._want_formats,
                 self._order,
-                self._parts,
+                self._items,
             ) = _query2pg(bquery, self._encoding)
+        elif vars is not None:
+            # No placeholder: no need to parse the query
+            self.query = bquery
+            self._want_formats = []
+            self._order = None
+            self._items = _NO_ITEMS
         else:
             self.query = bquery
             self._want_formats = self._order = None
@@ -86,7 +113,7 @@ class PostgresQuery:
         This method updates `params` and `types`.
         """
         if vars is not None:
-            params = _validate_and_reorder_params(self._parts, vars, self._order)
+            params = _validate_and_reorder_params(self._items, vars, self._order)
             assert self._want_formats is not None
             self.params = self._tx.dump_sequence(params, self._want_formats)
             self.types = self._tx.types or ()
@@ -112,16 +139,25 @@ class PostgresClientQuery(PostgresQuery):
         attributes (`query`, `params`, `types`, `formats`).
         """
         if isinstance(query, str):
-            bquery = query.encode(self._encoding)
+            if vars is not None and len(query) <= _MAX_CACHED_QUERY_LEN:
+                bquery = _encode_query(query, self._encoding)
+            else:
+                bquery = query.encode(self._encoding)
         elif isinstance(query, Composable):
             bquery = query.as_bytes(self._tx)
         else:
             bquery = query
 
-        if vars is not None:
-            (self.template, self._order, self._parts) = _query2pg_client(
+        # Note: an int needle is a plain memchr(), much faster than b"%"
+        if vars is not None and 0x25 in bquery:
+            (self.template, self._order, self._items) = _query2pg_client(
                 bquery, self._encoding
             )
+        elif vars is not None:
+            # No placeholder: no need to parse the query
+            self.template = bquery
+            self._order = None
+            self._items = _NO_ITEMS
         else:
             self.query = bquery
             self._order = None
@@ -135,19 +171,40 @@ class PostgresClientQuery(PostgresQuery):
         This method updates `params` and `types`.
         """
         if vars is not None:
-            params = _validate_and_reorder_params(self._parts, vars, self._order)
-            self.params = tuple(
-                self._tx.as_literal(p) if p is not None else b"NULL" for p in params
-            )
+            params = _validate_and_reorder_params(self._items, vars, self._order)
+            nparams = len(params)
+            literals = [b"NULL"] * nparams
+            as_literal = self._tx.as_literal
+            for i in range(nparams):
+                param = params[i]
+                if param is not None:
+                    literals[i] = as_literal(param)
+            self.params = tuple(literals)
             self.query = self.template % self.params
         else:
             self.params = None
 
 
-@lru_cache()
+@lru_cache(maxsize=_QUERY_CACHE_SIZE)
+def _encode_query(query: str, encoding: str) -> bytes:
+    """
+    Encode a query string, returning the same object for the same query.
+
+    Python caches the hash of the str object, so this is cheaper than encoding
+    a long query again, and then it spares hashing the new bytes to look up
+    the `_query2pg()` cache.
+    """
+    return query.encode(encoding)
+
+
+# Note: the query is looked up by value, but Python caches the hash of a bytes
+# object, so executing the same query object again doesn't hash it again and
+# the lookup is dominated by the cache call. A front cache by id(query) was
+# tried and measured twice as slow as this lookup.
+@lru_cache(maxsize=_QUERY_CACHE_SIZE)
 def _query2pg(
     query: bytes, encoding: str
-) -> Tuple[bytes, List[PyFormat], Optional[List[str]], List[QueryPart]]:
+) -> Tuple[bytes, List[PyFormat], Optional[List[str]], QueryItems]:
     """
     Convert Python query and params into something Postgres understands.
 
@@ -156,85 +213,70 @@ def _query2pg(
     - placeholders can be %s, %t, or %b (auto, text or binary)
     - return ``query`` (bytes), ``formats`` (list of formats) ``order``
       (sequence of names used in the query, in the position they appear)
-      ``parts`` (splits of queries and placeholders).
+      ``items`` (the placeholders found in the query).
     """
-    parts = _split_query(query, encoding)
+    pres, items, pformats = _split_query(query, encoding)
     order: Optional[List[str]] = None
     chunks: List[bytes] = []
-    formats = []
 
-    if isinstance(parts[0].item, int):
-        for part in parts[:-1]:
-            assert isinstance(part.item, int)
-            chunks.append(part.pre)
-            chunks.append(b"$%d" % (part.item + 1))
-            formats.append(part.format)
+    # _split_query() guarantees that the items are either all int or all str
+    indexes = cast(List[int], items)
+    names = cast(List[str], items)
+    if not items or isinstance(items[0], int):
+        # Every placeholder is a different parameter, with its own format
+        formats = pformats
+        for pre, item in zip(pres, indexes):
+            chunks.append(pre)
+            ph = _dollars[item] if item < len(_dollars) else b"$%d" % (item + 1)
+            chunks.append(ph)
 
-    elif isinstance(parts[0].item, str):
+    else:
         seen: Dict[str, Tuple[bytes, PyFormat]] = {}
         order = []
-        for part in parts[:-1]:
-            assert isinstance(part.item, str)
-            chunks.append(part.pre)
-            if part.item not in seen:
-                ph = b"$%d" % (len(seen) + 1)
-                seen[part.item] = (ph, part.format)
-                order.append(part.item)
-                chunks.append(ph)
-                formats.append(part.format)
-            else:
-                if seen[part.item][1] != part.format:
+        formats = []
+        for pre, name, format in zip(pres, names, pformats):
+            chunks.append(pre)
+            if name in seen:
+                ph, seen_format = seen[name]
+                if seen_format != format:
                     raise e.ProgrammingError(
-                        f"placeholder '{part.item}' cannot have different formats"
+                        f"placeholder '{name}' cannot have different formats"
                     )
-                chunks.append(seen[part.item][0])
+            else:
+                nseen = len(seen)
+                ph = _dollars[nseen] if nseen < len(_dollars) else b"$%d" % (nseen + 1)
+                seen[name] = (ph, format)
+                order.append(name)
+                formats.append(format)
+            chunks.append(ph)
 
     # last part
-    chunks.append(parts[-1].pre)
+    chunks.append(pres[-1])
 
-    return b"".join(chunks), formats, order, parts
+    return b"".join(chunks), formats, order, items
 
 
-@lru_cache()
+@lru_cache(maxsize=_QUERY_CACHE_SIZE)
 def _query2pg_client(
     query: bytes, encoding: str
-) -> Tuple[bytes, Optional[List[str]], List[QueryPart]]:
+) -> Tuple[bytes, Optional[List[str]], QueryItems]:
     """
     Convert Python query and params into a template to perform client-side binding
     """
-    parts = _split_query(query, encoding, collapse_double_percent=False)
-    order: Optional[List[str]] = None
-    chunks: List[bytes] = []
-
-    if isinstance(parts[0].item, int):
-        for part in parts[:-1]:
-            assert isinstance(part.item, int)
-            chunks.append(part.pre)
-            chunks.append(b"%s")
+    pres, items, _ = _split_query(query, encoding, collapse_double_percent=False)
 
-    elif isinstance(parts[0].item, str):
-        seen: Dict[str, Tuple[bytes, PyFormat]] = {}
-        order = []
-        for part in parts[:-1]:
-            assert isinstance(part.item, str)
-            chunks.append(part.pre)
-            if part.item not in seen:
-                ph = b"%s"
-                seen[part.item] = (ph, part.format)
-                order.append(part.item)
-                chunks.append(ph)
-            else:
-                chunks.append(seen[part.item][0])
-                order.append(part.item)
-
-    # last part
-    chunks.append(parts[-1].pre)
+    # Every placeholder, positional or named, is replaced by a '%s' in the
+    # template. Named parameters are passed in the order they appear.
+    order: Optional[List[str]] = None
+    names = cast(List[str], items)
+    if names and isinstance(names[0], str):
+        order = names[:]
 
-    return b"".join(chunks), order, parts
+    return b"%s".join(pres), order, items
 
 
 def _validate_and_reorder_params(
-    parts: List[QueryPart], vars: Params, order: Optional[List[str]]
+    items: QueryItems, vars: Params, order: Optional[List[str]]
 ) -> Sequence[Any]:
     """
     Verify the compatibility between a query and a set of params.
@@ -256,17 +298,17 @@ def _validate_and_reorder_params(
         )
 
     if sequence:
-        if len(vars) != len(parts) - 1:
+        if len(vars) != len(items):
             raise e.ProgrammingError(
-                f"the query has {len(parts) - 1} placeholders but"
+                f"the query has {len(items)} placeholders but"
                 f" {len(vars)} parameters were passed"
             )
-        if vars and not isinstance(parts[0].item, int):
+        if vars and not isinstance(items[0], int):
             raise TypeError("named placeholders require a mapping of parameters")
         return vars  # type: ignore[return-value]
 
     else:
-        if vars and len(parts) > 1 and not isinstance(parts[0][1], str):
+        if vars and items and not isinstance(items[0], str):
             raise TypeError(
                 "positional placeholders (%s) require a sequence of parameters"
             )
@@ -279,81 +321,78 @@ def _validate_and_reorder_params(
             )
 
 
-_re_placeholder = re.compile(
-    rb"""(?x)
-        %                       # a literal %
-        (?:
-            (?:
-                \( ([^)]+) \)   # or a name in (braces)
-                .               # followed by a format
-            )
-            |
-            (?:.)               # or any char, really
-        )
-        """
-)
-
-
-def _split_query(
+def _py_split_query(
     query: bytes, encoding: str = "ascii", collapse_double_percent: bool = True
-) -> List[QueryPart]:
-    parts: List[Tuple[bytes, Optional[Match[bytes]]]] = []
-    cur = 0
-
-    # pairs [(fragment, match], with the last match None
-    m = None
-    for m in _re_placeholder.finditer(query):
-        pre = query[cur : m.span(0)[0]]
-        parts.append((pre, m))
-        cur = m.span(0)[1]
-    if m:
-        parts.append((query[cur:], None))
-    else:
-        parts.append((query, None))
-
-    rv = []
+) -> Tuple[List[bytes], QueryItems, List[PyFormat]]:
+    """
+    Split a query into fragments and placeholders in a single scan.
 
-    # drop the "%%", validate
-    i = 0
+    Return the list of the query fragments and the parallel lists of the items
+    (indexes or names) and formats of the placeholders following each fragment.
+    The last fragment is not followed by a placeholder. Escaped ``%%`` are
+    accumulated into the following fragment.
+    """
+    pres: List[bytes] = []
+    items: List[Any] = []
+    formats: List[PyFormat] = []
     phtype = None
-    while i < len(parts):
-        pre, m = parts[i]
-        if m is None:
-            # last part
-            rv.append(QueryPart(pre, 0, PyFormat.AUTO))
+    # unescaped fragments preceding the current one, if any '%%' was found
+    pre_buf = bytearray()
+    nquery = len(query)
+    cur = 0  # start of the current fragment
+    pos = 0  # start of the scan for the next '%'
+
+    while True:
+        start = query.find(b"%", pos)
+        if start < 0 or start + 1 >= nquery:
+            # last part. A trailing '%' is not a placeholder
+            pres.append(bytes(pre_buf) + query[cur:])
             break
 
-        ph = m.group(0)
-        if ph == b"%%":
-            # unescape '%%' to '%' if necessary, then merge the parts
+        c = query[start + 1]
+        if c == 0x25:  # '%%'
             if collapse_double_percent:
-                ph = b"%"
-            pre1, m1 = parts[i + 1]
-            parts[i + 1] = (pre + ph + pre1, m1)
-            del parts[i]
+                # unescape '%%' to '%' and start a new fragment after it
+                pre_buf += query[cur : start + 1]
+                cur = start + 2
+            # else the '%%' just stays in the current fragment
+            pos = start + 2
             continue
 
-        if ph == b"%(":
-            raise e.ProgrammingError(
-                "incomplete placeholder:"
-                f" '{query[m.span(0)[0]:].split()[0].decode(encoding)}'"
-            )
-        elif ph == b"% ":
+        elif c == 0x0A:  # '%\n' is not a placeholder, just a '%'
+            pos = start + 1
+            continue
+
+        # Index or name
+        item: Union[int, str]
+        if c == 0x28:  # '('
+            close = query.find(b")", start + 2)
+            if close <= start + 2 or close + 1 >= nquery or query[close + 1] == 0x0A:
+                raise e.ProgrammingError(
+                    "incomplete placeholder:"
+                    f" '{query[start:].split()[0].decode(encoding)}'"
+                )
+            end = close + 2
+            item = query[start + 2 : close].decode(encoding)
+
+        elif c == 0x20:  # '% '
             # explicit messasge for a typical error
             raise e.ProgrammingError(
                 "incomplete placeholder: '%'; if you want to use '%' as an"
                 " operator you can double it up, i.e. use '%%'"
             )
-        elif ph[-1:] not in b"sbt":
+
+        else:
+            end = start + 2
+            item = len(items)
+
+        format = _ph_to_fmt.get(query[end - 1])
+        if format is None:
             raise e.ProgrammingError(
                 "only '%s', '%b', '%t' are allowed as placeholders, got"
-                f" '{m.group(0).decode(encoding)}'"
+                f" '{query[start:end].decode(encoding)}'"
             )
 
-        # Index or name
-        item: Union[int, str]
-        item = m.group(1).decode(encoding) if m.group(1) else i
-
         if not phtype:
             phtype = type(item)
         elif phtype is not type(item):
@@ -361,15 +400,31 @@ def _split_query(
                 "positional and named placeholders cannot be mixed"
             )
 
-        format = _ph_to_fmt[ph[-1:]]
-        rv.append(QueryPart(pre, item, format))
-        i += 1
+        if pre_buf:
+            pres.append(bytes(pre_buf) + query[cur:start])
+            pre_buf.clear()
+        else:
+            pres.append(query[cur:start])
+        items.append(item)
+        formats.append(format)
+        cur = pos = end
 
-    return rv
+    return pres, items, formats
 
 
+# Postgres placeholders for the most common number of parameters: $1, $2...
+_dollars = tuple(b"$%d" % i for i in range(1, 129))
+
+# Map the last byte of a placeholder to its format
 _ph_to_fmt = {
-    b"s": PyFormat.AUTO,
-    b"t": PyFormat.TEXT,
-    b"b": PyFormat.BINARY,
+    ord("s"): PyFormat.AUTO,
+    ord("t"): PyFormat.TEXT,
+    ord("b"): PyFormat.BINARY,
 }
+
+
+# Override functions with fast versions if available
+if _psycopg:
+    _split_query = _psycopg.split_query
+else:
+    _split_query = _py_split_query
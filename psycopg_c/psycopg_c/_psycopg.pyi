@@ -16,6 +16,7 @@ from psycopg.adapt import AdaptersMap, PyFormat
 from psycopg.pq.abc import PGconn, PGresult
 from psycopg.connection import BaseConnection
 from psycopg._compat import Deque
+from psycopg._queries import QueryItems
 
 class Transformer(abc.AdaptContext):
     types: Optional[Tuple[int, ...]]
@@ -65,6 +66,11 @@ def wait_c(
     gen: abc.PQGen[abc.RV], fileno: int, timeout: Optional[float] = None
 ) -> abc.RV: ...
 
+# Queries parsing
+def split_query(
+    query: bytes, encoding: str = "ascii", collapse_double_percent: bool = True
+) -> Tuple[List[bytes], QueryItems, List[PyFormat]]: ...
+
 # Copy support
 def format_row_text(
     row: Sequence[Any], tx: abc.Transformer, out: Optional[bytearray] = None
@@ -44,6 +44,7 @@ cdef extern from *:
 include "_psycopg/adapt.pyx"
 include "_psycopg/copy.pyx"
 include "_psycopg/generators.pyx"
+include "_psycopg/queries.pyx"
 include "_psycopg/transform.pyx"
 include "_psycopg/waiting.pyx"
 
@@ -0,0 +1,145 @@
+"""
+C optimised functions to manipulate queries.
+"""
+
+# Copyright (C) 2023 The Psycopg Team
+
+from libc.string cimport memchr, memcpy
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE, PyBytes_Check
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.bytearray cimport PyByteArray_AS_STRING, PyByteArray_GET_SIZE
+from cpython.bytearray cimport PyByteArray_Resize
+
+from psycopg import errors as e
+
+
+def split_query(
+    query,
+    encoding: str = "ascii",
+    bint collapse_double_percent = True,
+) -> Tuple[List[bytes], List[Any], List[PyFormat]]:
+    """
+    Split a query into fragments and placeholders in a single scan.
+
+    C implementation of `psycopg._queries._py_split_query()`.
+    """
+    # Accept bytes subclasses, which a typed bytes argument would reject
+    if not PyBytes_Check(query):
+        query = bytes(query)
+
+    cdef const char *buf = PyBytes_AS_STRING(query)
+    cdef Py_ssize_t nquery = PyBytes_GET_SIZE(query)
+    cdef const char *ptr
+    cdef char c
+    cdef Py_ssize_t start, end
+
+    cdef list pres = []
+    cdef list items = []
+    cdef list formats = []
+    cdef object item
+    cdef object format
+    cdef object phtype = None
+
+    # unescaped fragments preceding the current one, if any '%%' was found
+    cdef bytearray pre_buf = bytearray()
+    cdef Py_ssize_t cur = 0  # start of the current fragment
+    cdef Py_ssize_t pos = 0  # start of the scan for the next '%'
+
+    while True:
+        ptr = <const char *>memchr(buf + pos, b'%', nquery - pos)
+        if ptr == NULL or ptr - buf + 1 >= nquery:
+            # last part. A trailing '%' is not a placeholder
+            pres.append(_flush_fragment(pre_buf, buf + cur, nquery - cur))
+            break
+
+        start = ptr - buf
+        c = buf[start + 1]
+        if c == b'%':
+            if collapse_double_percent:
+                # unescape '%%' to '%' and start a new fragment after it
+                _buf_append(pre_buf, buf + cur, start + 1 - cur)
+                cur = start + 2
+            # else the '%%' just stays in the current fragment
+            pos = start + 2
+            continue
+
+        elif c == b'\n':
+            # '%\n' is not a placeholder, just a '%'
+            pos = start + 1
+            continue
+
+        # Index or name
+        if c == b'(':
+            ptr = <const char *>memchr(buf + start + 2, b')', nquery - start - 2)
+            if (
+                ptr == NULL
+                or ptr - buf == start + 2
+                or ptr - buf + 1 >= nquery
+                or ptr[1] == b'\n'
+            ):
+                raise e.ProgrammingError(
+                    "incomplete placeholder:"
+                    f" '{query[start:].split()[0].decode(encoding)}'"
+                )
+            end = ptr - buf + 2
+            item = query[start + 2 : end - 2].decode(encoding)
+
+        elif c == b' ':
+            # explicit messasge for a typical error
+            raise e.ProgrammingError(
+                "incomplete placeholder: '%'; if you want to use '%' as an"
+                " operator you can double it up, i.e. use '%%'"
+            )
+
+        else:
+            end = start + 2
+            item = len(items)
+
+        c = buf[end - 1]
+        if c == b's':
+            format = PG_AUTO
+        elif c == b'b':
+            format = PG_BINARY
+        elif c == b't':
+            format = PG_TEXT
+        else:
+            raise e.ProgrammingError(
+                "only '%s', '%b', '%t' are allowed as placeholders, got"
+                f" '{query[start:end].decode(encoding)}'"
+            )
+
+        if phtype is None:
+            phtype = type(item)
+        elif phtype is not type(item):
+            raise e.ProgrammingError(
+                "positional and named placeholders cannot be mixed"
+            )
+
+        pres.append(_flush_fragment(pre_buf, buf + cur, start - cur))
+        items.append(item)
+        formats.append(format)
+        cur = pos = end
+
+    return pres, items, formats
+
+
+cdef int _buf_append(bytearray buf, const char *data, Py_ssize_t size) except -1:
+    """Append `!size` bytes from `!data` to `!buf`."""
+    cdef Py_ssize_t nbuf = PyByteArray_GET_SIZE(buf)
+    PyByteArray_Resize(buf, nbuf + size)
+    memcpy(PyByteArray_AS_STRING(buf) + nbuf, data, size)
+    return 0
+
+
+cdef bytes _flush_fragment(bytearray buf, const char *data, Py_ssize_t size):
+    """Return the content of `!buf` followed by `!data`, and empty `!buf`."""
+    cdef Py_ssize_t nbuf = PyByteArray_GET_SIZE(buf)
+    if nbuf == 0:
+        return PyBytes_FromStringAndSize(data, size)
+
+    cdef bytes rv = PyBytes_FromStringAndSize(NULL, nbuf + size)
+    cdef char *target = PyBytes_AS_STRING(rv)
+    memcpy(target, PyByteArray_AS_STRING(buf), nbuf)
+    memcpy(target + nbuf, data, size)
+    PyByteArray_Resize(buf, 0)
+    return rv
@@ -2,8 +2,14 @@ import pytest
 
 import psycopg
 from psycopg import pq
+from psycopg.postgres import types as builtins
 from psycopg.adapt import Transformer, PyFormat
-from psycopg._queries import PostgresQuery, _split_query
+from psycopg._queries import PostgresQuery, PostgresClientQuery, _split_query
+from psycopg._queries import _encode_query, _MAX_CACHED_QUERY_LEN
+
+
+class MyBytes(bytes):
+    pass
 
 
 @pytest.mark.parametrize(
@@ -12,7 +18,13 @@ from psycopg._queries import PostgresQuery, _split_query
         (b"", [(b"", 0, PyFormat.AUTO)]),
         (b"foo bar", [(b"foo bar", 0, PyFormat.AUTO)]),
         (b"foo %% bar", [(b"foo % bar", 0, PyFormat.AUTO)]),
+        (b"foo %%%% bar %", [(b"foo %% bar %", 0, PyFormat.AUTO)]),
+        (b"foo %\nbar", [(b"foo %\nbar", 0, PyFormat.AUTO)]),
         (b"%s", [(b"", 0, PyFormat.AUTO), (b"", 0, PyFormat.AUTO)]),
+        (
+            MyBytes(b"foo %s bar"),
+            [(b"foo ", 0, PyFormat.AUTO), (b" bar", 0, PyFormat.AUTO)],
+        ),
         (b"%s foo", [(b"", 0, PyFormat.AUTO), (b" foo", 0, PyFormat.AUTO)]),
         (b"%b foo", [(b"", 0, PyFormat.BINARY), (b" foo", 0, PyFormat.AUTO)]),
         (b"foo %s", [(b"foo ", 0, PyFormat.AUTO), (b"", 0, PyFormat.AUTO)]),
@@ -44,7 +56,10 @@ from psycopg._queries import PostgresQuery, _split_query
     ],
 )
 def test_split_query(input, want):
-    assert _split_query(input) == want
+    pres, items, formats = _split_query(input)
+    assert pres == [w[0] for w in want]
+    assert items == [w[1] for w in want[:-1]]
+    assert formats == [w[2] for w in want[:-1]]
 
 
 @pytest.mark.parametrize(
@@ -57,6 +72,8 @@ def test_split_query(input, want):
         b"foo %(foo)s bar %s baz",
         b"foo %(foo) bar",
         b"foo %(foo bar",
+        b"foo %()s bar",
+        b"foo %(foo)\nbar",
         b"3%2",
     ],
 )
@@ -100,6 +117,7 @@ def test_pg_query_seq(query, params, want, wformats, wparams):
     "query, params, want, wformats, wparams",
     [
         (b"", {}, b"", [], []),
+        (b"select 1", {"a": 1}, b"select 1", [], []),
         (b"hello %%", {"a": 1}, b"hello %", [], []),
         (
             b"select %(hello)t",
@@ -125,6 +143,53 @@ def test_pg_query_map(query, params, want, wformats, wparams):
     assert pq.params == wparams
 
 
+@pytest.mark.parametrize(
+    "query, params, want",
+    [
+        (b"", None, b""),
+        (b"select 1", [], b"select 1"),
+        (b"select %s, %%", [None], b"select NULL, %"),
+        (b"select %% %s %%%%", ["a"], b"select % 'a' %%"),
+        (b"select %s, %s", ["a", None], b"select 'a', NULL"),
+        (b"select %(a)s, %(b)s, %(a)s", {"a": 1, "b": None}, b"select 1, NULL, 1"),
+    ],
+)
+def test_client_query(query, params, want):
+    pq = PostgresClientQuery(Transformer())
+    pq.convert(query, params)
+    assert pq.query == want
+
+
+@pytest.mark.parametrize("pgq", [PostgresQuery, PostgresClientQuery])
+def test_encode_query_cache(pgq):
+    pq = pgq(Transformer())
+    _encode_query.cache_clear()
+
+    # Queries without parameters are not cached
+    pq.convert(f"select 'no params {pgq.__name__}'", None)
+    assert _encode_query.cache_info().currsize == 0
+
+    # Neither are long queries
+    query = f"select %s -- {pgq.__name__} " + "x" * _MAX_CACHED_QUERY_LEN
+    pq.convert(query, [1])
+    assert _encode_query.cache_info().currsize == 0
+
+    pq.convert(f"select %s -- {pgq.__name__}", [1])
+    assert _encode_query.cache_info().currsize == 1
+
+
+def test_pg_query_dump_types_by_value():
+    # The dumpers chosen depend on the parameters values, not only on their
+    # types, so they cannot be reused across executions of the same query.
+    pq = PostgresQuery(Transformer())
+    pq.convert(b"select %s, %t", [1, 1])
+    assert pq.types == (builtins["int2"].oid, builtins["int2"].oid)
+    pq.dump([2**40, 2**40])
+    assert pq.types == (builtins["int8"].oid, builtins["int8"].oid)
+    pq.dump([None, 1])
+    assert pq.types == (0, builtins["int2"].oid)
+
+
 @pytest.mark.parametrize(
     "query, params",
     [